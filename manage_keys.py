@@ -7,17 +7,19 @@ Usage:
   python manage_keys.py list
   python manage_keys.py gen <username>   # auto-generate a key
 """
-import sys, json, secrets
+import sys, secrets
 from pathlib import Path
 
+import orjson
+
 KEYS_FILE = Path("api_keys.json")
 
 def load():
     if not KEYS_FILE.exists(): return {"keys": {}}
-    return json.loads(KEYS_FILE.read_text())
+    return orjson.loads(KEYS_FILE.read_bytes())
 
 def save(data):
-    KEYS_FILE.write_text(json.dumps(data, indent=2))
+    KEYS_FILE.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
     print("✅ Saved.")
 
 def main():
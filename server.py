@@ -8,65 +8,160 @@
 """
 
 import asyncio
-import json
+import heapq
 import secrets
+import threading
 import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+from itertools import islice
 from pathlib import Path
-from typing import Any, cast
+from typing import Any, AsyncIterator, Callable, cast
+from urllib.parse import parse_qs, urlparse
 
+import fastapi
 from fastapi import FastAPI, HTTPException, Depends, Query, Body
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import APIKeyHeader
+import aiofiles
+import aiofiles.os
+from cachetools import TLRUCache, TTLCache
+import msgspec
+import orjson
 import yt_dlp
 from yt_dlp.utils import DownloadError
 
 # ── Config ──────────────────────────────────────────────────────────────────
 API_KEYS_FILE   = Path("api_keys.json")
 USER_DATA_DIR   = Path("user_data")
-Path("cache").mkdir(exist_ok=True)
+CACHE_DIR       = Path("cache")
+AUDIO_CACHE_FILE = CACHE_DIR / "audio_url.json"
+CACHE_DIR.mkdir(exist_ok=True)
 USER_DATA_DIR.mkdir(exist_ok=True)
 
 SEARCH_CACHE_TTL  = 60 * 30        # 30 min
-AUDIO_URL_TTL     = 60 * 60 * 4   # 4 h  (YouTube signed URLs last ~6 h)
+SEARCH_CACHE_MAX  = 50            # per-user search cache entries kept after a trim
+SEARCH_CACHE_SLACK = 10           # extra entries allowed before trimming
+YTDLP_WORKERS     = 8             # threads dedicated to yt-dlp extractions
+AUDIO_URL_TTL     = 60 * 60 * 4   # 4 h  (upper bound; the URL's own expire= param is honoured)
+AUDIO_URL_MARGIN  = 60            # 1 min safety margin before a signed URL expires
 RELATED_CACHE_TTL = 60 * 60       # 1 h
+KEYS_CACHE_TTL    = 30            # 30 s (reloaded early if api_keys.json changes)
+USER_FLUSH_INTERVAL = 2           # 2 s  between write-behind flushes of user data
+MEMORY_CACHE_SIZE = 1024          # max entries per in-memory video cache
 
 if not API_KEYS_FILE.exists():
     key = secrets.token_urlsafe(16)
-    API_KEYS_FILE.write_text(json.dumps({"keys": {"admin": key}}, indent=2))
+    API_KEYS_FILE.write_bytes(orjson.dumps({"keys": {"admin": key}}, option=orjson.OPT_INDENT_2))
     print(f"⚠️  Created api_keys.json — admin key: {key}")
 
 
-def load_keys() -> dict[str, str]:
-    return cast(dict[str, str], json.loads(API_KEYS_FILE.read_text())["keys"])
+# (loaded_at, mtime, {username: key}, {key: username})
+_keys_cache: tuple[float, float, dict[str, str], dict[str, str]] | None = None
+
+
+def _load_keys_cached() -> tuple[dict[str, str], dict[str, str]]:
+    """Returns (keys, owners), re-reading api_keys.json only when stale or modified."""
+    global _keys_cache
+    now = time.time()
+    mtime = API_KEYS_FILE.stat().st_mtime
+    if _keys_cache and (now - _keys_cache[0]) < KEYS_CACHE_TTL and _keys_cache[1] == mtime:
+        return _keys_cache[2], _keys_cache[3]
+    keys = cast(dict[str, str], orjson.loads(API_KEYS_FILE.read_bytes())["keys"])
+    owners = {k: u for u, k in keys.items()}
+    _keys_cache = (now, mtime, keys, owners)
+    return keys, owners
+
+
+# ── Models ───────────────────────────────────────────────────────────────────
+class Track(msgspec.Struct):
+    """Search / related result; encoded straight to JSON by msgspec."""
+    id: str
+    title: str | None
+    channel: str | None
+    duration: int | float | None
+    thumbnail: str
+    url: str
 
 
 # ── In-memory caches ─────────────────────────────────────────────────────────
-# { video_id: {"url": str, "ts": float} }
-_audio_url_cache: dict[str, dict[str, Any]] = {}
+# { video_id: {"url": str, "expires_at": float} }  — each entry lives until its own expires_at
+_audio_url_cache: TLRUCache[str, dict[str, Any]] = TLRUCache(
+    maxsize=MEMORY_CACHE_SIZE, ttu=lambda _k, v, _now: v["expires_at"], timer=time.time
+)
 
 # { video_id: asyncio.Event }  — deduplicates concurrent fetches
 _audio_url_inflight: dict[str, asyncio.Event] = {}
 
-# { video_id: {"info": dict, "ts": float} }
-_track_info_cache: dict[str, dict[str, Any]] = {}
+# { video_id: track_info }
+_track_info_cache: TTLCache[str, dict[str, Any]] = TTLCache(maxsize=MEMORY_CACHE_SIZE, ttl=AUDIO_URL_TTL)
+
+# { video_id: related tracks }
+_related_cache: TTLCache[str, list[Track]] = TTLCache(maxsize=MEMORY_CACHE_SIZE, ttl=RELATED_CACHE_TTL)
+
+# { video_id: asyncio.Event }  — deduplicates concurrent related fetches
+_related_inflight: dict[str, asyncio.Event] = {}
+
+# { (username, query_key): asyncio.Event }  — deduplicates concurrent searches
+_search_inflight: dict[tuple[str, str], asyncio.Event] = {}
 
-# { video_id: {"related": list, "ts": float} }
-_related_cache: dict[str, dict[str, Any]] = {}
+
+# { username: user document }  — write-behind cache, flushed by _user_flush_loop
+_user_cache: dict[str, dict[str, Any]] = {}
+
+# usernames whose in-memory document differs from disk
+_user_dirty: set[str] = set()
+
+# usernames whose last flush failed (already warned about)
+_user_flush_failing: set[str] = set()
 
 
 # ── FastAPI app ──────────────────────────────────────────────────────────────
-app = FastAPI(title="🎵 Pi Music Server", version="2.0.0")
+@asynccontextmanager
+async def lifespan(_app: FastAPI) -> AsyncIterator[None]:
+    """Startup / shutdown, in order. The helpers it calls are defined further down."""
+    # yt-dlp extractions are slow and network-bound; keep them off the default pool so they
+    # can't starve the small blocking jobs (aiofiles disk I/O) that share it.
+    _app.state.ytdlp_exec = ThreadPoolExecutor(max_workers=YTDLP_WORKERS, thread_name_prefix="ytdlp")
+    await load_audio_cache()
+    flush_task = asyncio.create_task(_user_flush_loop())
+    try:
+        yield
+    finally:
+        # 1. Stop the periodic flush, letting an in-progress one unwind (re-marking its
+        #    user dirty), then flush everything that's left
+        flush_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await flush_task
+        await flush_users()
+        # 2. Persist the audio URL cache for the next start
+        try:
+            await save_audio_cache()
+        except OSError as exc:
+            print(f"⚠️  Failed to save audio cache: {exc}")
+        # 3. Nothing else will call yt-dlp now
+        _app.state.ytdlp_exec.shutdown(wait=False, cancel_futures=True)
+
+
+# FastAPI >= 0.131 serializes annotated return values straight to JSON bytes itself (and
+# deprecates ORJSONResponse); older versions need ORJSONResponse for the fast path.
+_FASTAPI_VERSION = tuple(int(p) for p in fastapi.__version__.split(".")[:2])
+_DEFAULT_RESPONSE = JSONResponse if _FASTAPI_VERSION >= (0, 131) else ORJSONResponse
+
+app = FastAPI(title="🎵 Pi Music Server", version="2.0.0", default_response_class=_DEFAULT_RESPONSE,
+              lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
 security = APIKeyHeader(name="X-API-Key", auto_error=False)
 
 
 async def get_user(api_key: str = Depends(security)) -> str:
-    keys = load_keys()
-    if api_key not in keys.values():
+    _, owners = _load_keys_cached()
+    username = owners.get(api_key) if api_key else None
+    if not username:
         raise HTTPException(status_code=403, detail="Invalid API key")
-    return next(u for u, k in keys.items() if k == api_key)
+    return username
 
 
 # ── User data helpers ────────────────────────────────────────────────────────
@@ -74,22 +169,101 @@ def user_file(username: str) -> Path:
     return USER_DATA_DIR / f"{username}.json"
 
 
-def load_user(username: str) -> dict[str, Any]:
+def _migrate_user(username: str, data: dict[str, Any]) -> dict[str, Any]:
+    """Upgrade documents written by older versions to the current schema in place."""
+    # History used to be a newest-first list; now { video_id: track } oldest → newest
+    if isinstance(data.get("history"), list):
+        data["history"] = {
+            str(t["id"]): {**t, "id": str(t["id"])} for t in reversed(data["history"]) if t.get("id")
+        }
+    for pl in data.get("playlists", {}).values():
+        # Playlist tracks used to be a list; now { video_id: track } in playlist order
+        if isinstance(pl.get("tracks"), list):
+            # (ids are normalised to str — they become JSON object keys)
+            tracks = {str(t["id"]): {**t, "id": str(t["id"])} for t in pl["tracks"] if t.get("id")}
+            dropped = sum(1 for t in pl["tracks"] if not t.get("id"))
+            if dropped:
+                print(f"⚠️  Dropped {dropped} track(s) without an id from "
+                      f"'{username}' playlist '{pl.get('name', 'Untitled')}' during upgrade")
+            pl["tracks"] = tracks
+    return data
+
+
+async def load_user(username: str) -> dict[str, Any]:
+    """Returns the user's live in-memory document, reading it from disk only once."""
+    cached = _user_cache.get(username)
+    if cached is not None:
+        return cached
     f = user_file(username)
     if f.exists():
-        return cast(dict[str, Any], json.loads(f.read_text()))
-    return {"history": [], "search_cache": {}, "liked": [], "playlists": {}}
+        async with aiofiles.open(f, "rb") as fh:
+            data = _migrate_user(username, cast(dict[str, Any], orjson.loads(await fh.read())))
+    else:
+        data = {"history": {}, "search_cache": {}, "liked": [], "playlists": {}}
+    # Another request may have loaded (and modified) it while we were reading
+    return _user_cache.setdefault(username, data)
 
 
 def save_user(username: str, data: dict[str, Any]) -> None:
-    user_file(username).write_text(json.dumps(data, indent=2))
+    """Updates the in-memory document; the flush loop writes it to disk shortly after."""
+    _user_cache[username] = data
+    _user_dirty.add(username)
+
 
+async def flush_users() -> None:
+    """Write every dirty user document to disk (serialized on the loop, written off it).
 
-def record_play(username: str, track: dict[str, Any]) -> None:
-    data = load_user(username)
-    data["history"] = [t for t in data["history"] if t.get("id") != track.get("id")]
-    data["history"].insert(0, track)
-    data["history"] = data["history"][:200]
+    A user whose write fails (or is interrupted) stays dirty for the next flush; one whose
+    document can't be serialized is skipped until save_user marks it dirty again.
+    """
+    for username in list(_user_dirty):
+        _user_dirty.discard(username)
+        path = user_file(username)
+        tmp = path.with_suffix(".tmp")
+        try:
+            payload = orjson.dumps(_user_cache[username], default=msgspec.to_builtins)
+        except orjson.JSONEncodeError as exc:
+            # Retrying can't help; wait for the next save_user to mark the user dirty again
+            if username not in _user_flush_failing:
+                _user_flush_failing.add(username)
+                print(f"⚠️  User data for '{username}' can't be serialized, not flushing: {exc!r}")
+            continue
+        try:
+            # Write-then-rename so a crash mid-write never leaves a truncated file
+            async with aiofiles.open(tmp, "wb") as fh:
+                await fh.write(payload)
+            await aiofiles.os.replace(tmp, path)
+        except Exception as exc:
+            _user_dirty.add(username)
+            # Warn once per failure streak rather than every USER_FLUSH_INTERVAL
+            if username not in _user_flush_failing:
+                _user_flush_failing.add(username)
+                print(f"⚠️  Failed to flush user data for '{username}': {exc!r}")
+        except BaseException:
+            _user_dirty.add(username)
+            raise
+        else:
+            if username in _user_flush_failing:
+                _user_flush_failing.discard(username)
+                print(f"✅ Flushed user data for '{username}' again")
+
+
+async def _user_flush_loop() -> None:
+    while True:
+        await asyncio.sleep(USER_FLUSH_INTERVAL)
+        await flush_users()
+
+
+async def record_play(username: str, track: dict[str, Any]) -> None:
+    if not track.get("id"):
+        return
+    data = await load_user(username)
+    history: dict[str, dict[str, Any]] = data.setdefault("history", {})
+    # Re-inserting moves the track to the newest end
+    history.pop(track["id"], None)
+    history[track["id"]] = track
+    while len(history) > 200:
+        del history[next(iter(history))]
     save_user(username, data)
 
 
@@ -104,160 +278,301 @@ def _related_params() -> Any:
     return cast(Any, {"quiet": True, "no_warnings": True, "extract_flat": True, "playlistend": 15})
 
 
+# YoutubeDL is expensive to build and not thread-safe, so each yt-dlp pool worker
+# keeps one instance per param profile and reuses it across calls.
+_ydl_local = threading.local()
+
+
+def _ydl(params: Callable[[], Any]) -> yt_dlp.YoutubeDL:
+    ydl: yt_dlp.YoutubeDL | None = getattr(_ydl_local, params.__name__, None)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(params())
+        setattr(_ydl_local, params.__name__, ydl)
+    return ydl
+
+
 # ── yt-dlp sync helpers (run in thread pool) ─────────────────────────────────
-def _entry_to_track(e: dict[str, Any]) -> dict[str, Any]:
+def _entry_to_track(e: dict[str, Any]) -> Track:
     vid_id: str = e.get("id") or ""
-    return {
-        "id": vid_id,
-        "title": e.get("title"),
-        "channel": e.get("uploader") or e.get("channel"),
-        "duration": e.get("duration"),
-        "thumbnail": e.get("thumbnail") or f"https://i.ytimg.com/vi/{vid_id}/mqdefault.jpg",
-        "url": f"https://www.youtube.com/watch?v={vid_id}",
+    return Track(
+        id=vid_id,
+        title=e.get("title"),
+        channel=e.get("uploader") or e.get("channel"),
+        duration=e.get("duration"),
+        thumbnail=e.get("thumbnail") or f"https://i.ytimg.com/vi/{vid_id}/mqdefault.jpg",
+        url=f"https://www.youtube.com/watch?v={vid_id}",
+    )
+
+
+def _sync_search(query: str) -> list[Track]:
+    ydl = _ydl(_search_params)
+    raw = ydl.extract_info(f"ytsearch10:{query}", download=False)
+    info: dict[str, Any] = raw if isinstance(raw, dict) else {}
+    entries: list[dict[str, Any]] = info.get("entries") or []
+    return [_entry_to_track(e) for e in entries if e.get("id")]
+
+
+def _url_expiry(url: str) -> float | None:
+    """Unix time at which a signed googlevideo URL stops working, if it says."""
+    expire = parse_qs(urlparse(url).query).get("expire")
+    try:
+        return float(expire[0]) if expire else None
+    except ValueError:
+        return None
+
+
+def _sync_audio_url(video_id: str) -> tuple[str, float | None, dict[str, Any]]:
+    """Returns (audio_url, url_expiry, track_info) together to avoid a second network call."""
+    ydl = _ydl(_info_params)
+    raw = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
+    info: dict[str, Any] = raw if isinstance(raw, dict) else {}
+    formats: list[dict[str, Any]] = info.get("formats") or []
+    best = max(
+        (f for f in formats if f.get("acodec") != "none" and f.get("url")),
+        key=lambda x: x.get("abr") or 0,
+        default=None,
+    )
+    if not best:
+        raise ValueError("No audio format found")
+    audio_url = str(best["url"])
+    desc: str = info.get("description") or ""
+    track_info: dict[str, Any] = {
+        "id": info.get("id"),
+        "title": info.get("title"),
+        "channel": info.get("uploader"),
+        "duration": info.get("duration"),
+        "thumbnail": info.get("thumbnail"),
+        "description": desc[:300],
     }
+    return audio_url, _url_expiry(audio_url), track_info
 
 
-def _sync_search(query: str) -> list[dict[str, Any]]:
-    with yt_dlp.YoutubeDL(_search_params()) as ydl:
-        raw = ydl.extract_info(f"ytsearch10:{query}", download=False)
-        info: dict[str, Any] = raw if isinstance(raw, dict) else {}
-        entries: list[dict[str, Any]] = info.get("entries") or []
-        return [_entry_to_track(e) for e in entries if e.get("id")]
-
-
-def _sync_audio_url(video_id: str) -> tuple[str, dict[str, Any]]:
-    """Returns (audio_url, track_info) together to avoid a second network call."""
-    with yt_dlp.YoutubeDL(_info_params()) as ydl:
-        raw = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
-        info: dict[str, Any] = raw if isinstance(raw, dict) else {}
-        formats: list[dict[str, Any]] = info.get("formats") or []
-        audio_url = ""
-        for fmt in sorted(formats, key=lambda x: x.get("abr") or 0, reverse=True):
-            if fmt.get("acodec") != "none" and fmt.get("url"):
-                audio_url = str(fmt["url"])
-                break
-        if not audio_url:
-            raise ValueError("No audio format found")
-        desc: str = info.get("description") or ""
-        track_info: dict[str, Any] = {
-            "id": info.get("id"),
-            "title": info.get("title"),
-            "channel": info.get("uploader"),
-            "duration": info.get("duration"),
-            "thumbnail": info.get("thumbnail"),
-            "description": desc[:300],
-        }
-        return audio_url, track_info
-
-
-def _sync_related(video_id: str) -> list[dict[str, Any]]:
+def _sync_related(video_id: str) -> list[Track]:
     mix_url = f"https://www.youtube.com/watch?v={video_id}&list=RD{video_id}"
-    with yt_dlp.YoutubeDL(_related_params()) as ydl:
-        raw = ydl.extract_info(mix_url, download=False)
-        info: dict[str, Any] = raw if isinstance(raw, dict) else {}
-        entries: list[dict[str, Any]] = info.get("entries") or []
-        return [
-            _entry_to_track(e)
-            for e in entries
-            if e.get("id") and e.get("id") != video_id
-        ][:12]
+    ydl = _ydl(_related_params)
+    raw = ydl.extract_info(mix_url, download=False)
+    info: dict[str, Any] = raw if isinstance(raw, dict) else {}
+    entries: list[dict[str, Any]] = info.get("entries") or []
+    return [
+        _entry_to_track(e)
+        for e in entries
+        if e.get("id") and e.get("id") != video_id
+    ][:12]
 
 
 # ── Async wrappers with caching ──────────────────────────────────────────────
-async def _run(fn: Any, *args: Any) -> Any:
-    """Run a sync function in the default thread-pool executor."""
+def _ytdlp_pool() -> Executor:
+    """Dedicated yt-dlp thread pool; owned by the app's lifespan."""
+    return cast(Executor, app.state.ytdlp_exec)
+
+
+async def _run(fn: Any, *args: Any, pool: Executor | None = None) -> Any:
+    """Run a sync function in `pool` (default: the loop's default thread-pool executor)."""
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, fn, *args)
+    return await loop.run_in_executor(pool, fn, *args)
 
 
 async def fetch_stream(video_id: str) -> tuple[str, dict[str, Any]]:
     """
     Returns (audio_url, track_info).
-    - Checks in-memory audio URL cache first (TTL = 4 h)
+    - Checks in-memory audio URL cache first (until the URL's expire= minus 1 min, max 4 h)
     - Deduplicates concurrent requests for the same video_id via asyncio.Event
     - Populates track_info cache as a side-effect
     """
     # Cache hit
     cached = _audio_url_cache.get(video_id)
-    if cached and (time.time() - cached["ts"]) < AUDIO_URL_TTL:
-        track = _track_info_cache.get(video_id, {}).get("info") or {}
-        return cached["url"], track
+    if cached:
+        return cached["url"], _track_info_cache.get(video_id) or {}
 
     # Deduplication: if another coroutine is already fetching this id, wait for it
     if video_id in _audio_url_inflight:
         await _audio_url_inflight[video_id].wait()
         cached = _audio_url_cache.get(video_id)
         if cached:
-            track = _track_info_cache.get(video_id, {}).get("info") or {}
-            return cached["url"], track
+            return cached["url"], _track_info_cache.get(video_id) or {}
 
     event = asyncio.Event()
     _audio_url_inflight[video_id] = event
     try:
-        audio_url, track_info = await _run(_sync_audio_url, video_id)
-        _audio_url_cache[video_id] = {"url": audio_url, "ts": time.time()}
-        _track_info_cache[video_id] = {"info": track_info, "ts": time.time()}
+        audio_url, url_expiry, track_info = await _run(_sync_audio_url, video_id, pool=_ytdlp_pool())
+        expires_at = time.time() + AUDIO_URL_TTL
+        if url_expiry:
+            expires_at = min(expires_at, url_expiry - AUDIO_URL_MARGIN)
+        _audio_url_cache[video_id] = {"url": audio_url, "expires_at": expires_at}
+        _track_info_cache[video_id] = track_info
         return audio_url, track_info
     finally:
         event.set()
         _audio_url_inflight.pop(video_id, None)
 
 
-async def fetch_related(video_id: str) -> list[dict[str, Any]]:
+async def fetch_related(video_id: str) -> list[Track]:
     cached = _related_cache.get(video_id)
-    if cached and (time.time() - cached["ts"]) < RELATED_CACHE_TTL:
-        return cast(list[dict[str, Any]], cached["related"])
+    if cached is not None:
+        return cached
+
+    if video_id in _related_inflight:
+        await _related_inflight[video_id].wait()
+        cached = _related_cache.get(video_id)
+        if cached is not None:
+            return cached
+
+    event = asyncio.Event()
+    _related_inflight[video_id] = event
     try:
-        related = await _run(_sync_related, video_id)
-    except DownloadError:
-        related = []
-    _related_cache[video_id] = {"related": related, "ts": time.time()}
-    return related
+        try:
+            related = await _run(_sync_related, video_id, pool=_ytdlp_pool())
+        except DownloadError:
+            related = []
+        _related_cache[video_id] = related
+        return related
+    finally:
+        event.set()
+        _related_inflight.pop(video_id, None)
 
 
 async def fetch_track_info(video_id: str) -> dict[str, Any]:
     cached = _track_info_cache.get(video_id)
-    if cached and (time.time() - cached["ts"]) < AUDIO_URL_TTL:
-        return cast(dict[str, Any], cached["info"])
+    if cached:
+        return cached
     # Re-use fetch_stream to avoid double network call
     _, info = await fetch_stream(video_id)
     return info
 
 
 # ── Search cache (per-user, persisted) ───────────────────────────────────────
-async def cached_search(username: str, query: str) -> list[dict[str, Any]]:
-    data = load_user(username)
+def _as_tracks(entry: dict[str, Any]) -> list[Track]:
+    """Cached results reload from disk as dicts; convert them to Track once, in place."""
+    results: list[Any] = entry["results"]
+    if results and not isinstance(results[0], Track):
+        # Same JSON on disk either way, so the user isn't marked dirty
+        results = entry["results"] = msgspec.convert(results, list[Track])
+    return results
+
+
+async def cached_search(username: str, query: str) -> list[Track]:
+    data = await load_user(username)
     cache: dict[str, Any] = data.get("search_cache", {})
     key = query.lower().strip()
     entry: dict[str, Any] | None = cache.get(key)
     if entry and (time.time() - entry["ts"]) < SEARCH_CACHE_TTL:
-        return cast(list[dict[str, Any]], entry["results"])
+        return _as_tracks(entry)
 
-    results = await _run(_sync_search, query)
-    cache[key] = {"ts": time.time(), "results": results}
-    if len(cache) > 50:
-        cache = dict(sorted(cache.items(), key=lambda x: x[1]["ts"])[-50:])
-    data["search_cache"] = cache
-    save_user(username, data)
-    return results
+    # Deduplication: if this user already has the same search running, wait for it
+    inflight_key = (username, key)
+    if inflight_key in _search_inflight:
+        await _search_inflight[inflight_key].wait()
+        entry = (await load_user(username)).get("search_cache", {}).get(key)
+        # Only reuse it if the leading search actually refreshed it (it may have failed)
+        if entry and (time.time() - entry["ts"]) < SEARCH_CACHE_TTL:
+            return _as_tracks(entry)
+
+    event = asyncio.Event()
+    _search_inflight[inflight_key] = event
+    try:
+        results = await _run(_sync_search, query, pool=_ytdlp_pool())
+        data = await load_user(username)
+        cache = data.get("search_cache", {})
+        cache[key] = {"ts": time.time(), "results": results}
+        # Trim in batches so eviction doesn't run on every insert past the limit
+        if len(cache) > SEARCH_CACHE_MAX + SEARCH_CACHE_SLACK:
+            cache = dict(heapq.nlargest(SEARCH_CACHE_MAX, cache.items(), key=lambda x: x[1]["ts"]))
+        data["search_cache"] = cache
+        save_user(username, data)
+        return results
+    finally:
+        event.set()
+        _search_inflight.pop(inflight_key, None)
+
+
+# ── Background tasks ──────────────────────────────────────────────────────────
+# Strong references so fire-and-forget tasks aren't garbage-collected mid-flight
+_background_tasks: set[asyncio.Task[Any]] = set()
+
+
+def _track_background(task: asyncio.Task[Any]) -> asyncio.Task[Any]:
+    """Keep `task` alive until done and retrieve its result so failures are never unhandled."""
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
+def _background_done(task: asyncio.Task[Any]) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled():
+        task.exception()  # marks it retrieved; callers that care await the task themselves
 
 
 # ── Background prefetch ───────────────────────────────────────────────────────
+# Caps concurrent prefetch extractions so bursts of clients can't flood the thread pool
+_PREFETCH_SEM = asyncio.Semaphore(3)
+
+
 async def prefetch_next(video_ids: list[str]) -> None:
     """Fire-and-forget: warm up audio URL cache for upcoming tracks."""
     for vid in video_ids[:3]:
-        if vid not in _audio_url_cache:
-            asyncio.create_task(_prefetch_one(vid))
+        if vid not in _audio_url_cache and vid not in _audio_url_inflight:
+            _track_background(asyncio.create_task(_prefetch_one(vid)))
 
 
 async def _prefetch_one(video_id: str) -> None:
+    async with _PREFETCH_SEM:
+        # May have been fetched by a user while this prefetch was queued
+        if video_id in _audio_url_cache or video_id in _audio_url_inflight:
+            return
+        try:
+            await fetch_stream(video_id)
+        except Exception:  # noqa: BLE001 — prefetch failures are silent
+            pass
+
+
+# ── Audio cache persistence ───────────────────────────────────────────────────
+async def load_audio_cache() -> None:
+    """Warm the audio URL / track info caches with entries saved by the last shutdown."""
+    if not AUDIO_CACHE_FILE.exists():
+        return
     try:
-        await fetch_stream(video_id)
-    except Exception:  # noqa: BLE001 — prefetch failures are silent
-        pass
+        async with aiofiles.open(AUDIO_CACHE_FILE, "rb") as fh:
+            saved: Any = orjson.loads(await fh.read())
+    except (OSError, orjson.JSONDecodeError) as exc:
+        print(f"⚠️  Ignoring unreadable {AUDIO_CACHE_FILE}: {exc}")
+        return
+    if not isinstance(saved, dict):
+        print(f"⚠️  Ignoring malformed {AUDIO_CACHE_FILE}")
+        return
+    now = time.time()
+    for video_id, entry in saved.items():
+        # Skip anything malformed rather than failing startup over a stale cache file
+        if not (
+            isinstance(entry, dict)
+            and isinstance(entry.get("url"), str)
+            and isinstance(entry.get("expires_at"), (int, float))
+        ):
+            continue
+        if entry["expires_at"] <= now:
+            continue
+        _audio_url_cache[video_id] = {"url": entry["url"], "expires_at": entry["expires_at"]}
+        if isinstance(entry.get("info"), dict):
+            _track_info_cache[video_id] = entry["info"]
+
+
+async def save_audio_cache() -> None:
+    """Persist unexpired audio URLs (with their track info) so restarts start warm."""
+    saved = {
+        video_id: {**entry, "info": _track_info_cache.get(video_id)}
+        for video_id, entry in _audio_url_cache.items()
+    }
+    tmp = AUDIO_CACHE_FILE.with_suffix(".tmp")
+    async with aiofiles.open(tmp, "wb") as fh:
+        await fh.write(orjson.dumps(saved))
+    await aiofiles.os.replace(tmp, AUDIO_CACHE_FILE)
 
 
 # ── Routes ───────────────────────────────────────────────────────────────────
+def _msgspec_response(content: Any) -> Response:
+    """Encode with msgspec directly, skipping jsonable_encoder and response validation."""
+    return Response(content=msgspec.json.encode(content), media_type="application/json")
+
 
 @app.get("/", response_class=HTMLResponse)
 async def web_ui() -> HTMLResponse:
@@ -268,9 +583,9 @@ async def web_ui() -> HTMLResponse:
 async def search(
     q: str = Query(..., min_length=1),
     username: str = Depends(get_user),
-) -> dict[str, Any]:
+) -> Response:
     results = await cached_search(username, q)
-    return {"results": results}
+    return _msgspec_response({"results": results})
 
 
 @app.get("/api/stream/{video_id}")
@@ -278,42 +593,51 @@ async def stream_audio(
     video_id: str,
     next_ids: str = Query(default=""),   # comma-separated next track IDs for prefetch
     username: str = Depends(get_user),
-) -> dict[str, Any]:
+) -> Response:
     try:
         audio_url, track_info = await fetch_stream(video_id)
-        record_play(username, track_info)
+        await record_play(username, track_info)
         # Prefetch next tracks in background
         if next_ids:
             await prefetch_next([v for v in next_ids.split(",") if v])
-        return {"stream_url": audio_url, "track": track_info}
+        return _msgspec_response({"stream_url": audio_url, "track": track_info})
     except (ValueError, DownloadError) as exc:
         raise HTTPException(status_code=500, detail=str(exc)) from exc
 
 
 @app.get("/api/suggestions")
-async def suggestions(username: str = Depends(get_user)) -> dict[str, Any]:
-    data = load_user(username)
-    history: list[dict[str, Any]] = data.get("history", [])
-    if not history:
+async def suggestions(username: str = Depends(get_user)) -> Response:
+    data = await load_user(username)
+    history: dict[str, dict[str, Any]] = data.get("history", {})
+    seed = next(reversed(history.values()), None)
+    if not seed:
         results = await cached_search(username, "trending music 2025")
-        return {"suggestions": results, "based_on": "trending"}
-    seed = history[0]
-    related = await fetch_related(seed["id"])
-    if not related:
-        channel: str = seed.get("channel") or "music"
+        return _msgspec_response({"suggestions": results, "based_on": "trending"})
+    channel: str = seed.get("channel") or "music"
+    related = _related_cache.get(seed["id"])
+    if related is None:
+        # Cold: run the channel-search fallback alongside the mix lookup to hide its latency.
+        # It is never cancelled — the extraction can't be stopped once on the yt-dlp pool, so it
+        # is left to finish into the search cache even when the mix wins.
+        fallback_task = _track_background(asyncio.create_task(cached_search(username, f"{channel} music")))
+        related = await fetch_related(seed["id"])
+        if not related:
+            related = await fallback_task
+    elif not related:
         related = await cached_search(username, f"{channel} music")
-    return {"suggestions": related, "based_on": seed.get("title", "recent")}
+    return _msgspec_response({"suggestions": related, "based_on": seed.get("title", "recent")})
 
 
 @app.get("/api/history")
 async def get_history(username: str = Depends(get_user)) -> dict[str, Any]:
-    data = load_user(username)
-    return {"history": data.get("history", [])[:50]}
+    data = await load_user(username)
+    history: dict[str, dict[str, Any]] = data.get("history", {})
+    return {"history": list(islice(reversed(history.values()), 50))}
 
 
 @app.post("/api/like/{video_id}")
 async def like_track(video_id: str, username: str = Depends(get_user)) -> dict[str, Any]:
-    data = load_user(username)
+    data = await load_user(username)
     liked: list[str] = data.get("liked", [])
     if video_id not in liked:
         liked.insert(0, video_id)
@@ -324,7 +648,7 @@ async def like_track(video_id: str, username: str = Depends(get_user)) -> dict[s
 
 @app.delete("/api/like/{video_id}")
 async def unlike_track(video_id: str, username: str = Depends(get_user)) -> dict[str, Any]:
-    data = load_user(username)
+    data = await load_user(username)
     data["liked"] = [v for v in data.get("liked", []) if v != video_id]
     save_user(username, data)
     return {"liked": False}
@@ -332,7 +656,7 @@ async def unlike_track(video_id: str, username: str = Depends(get_user)) -> dict
 
 @app.get("/api/liked")
 async def get_liked(username: str = Depends(get_user)) -> dict[str, Any]:
-    data = load_user(username)
+    data = await load_user(username)
     return {"liked": data.get("liked", [])}
 
 
@@ -357,6 +681,8 @@ async def cache_stats(username: str = Depends(get_user)) -> dict[str, Any]:  # n
         "track_info_cache": len(_track_info_cache),
         "related_cache": len(_related_cache),
         "inflight": list(_audio_url_inflight.keys()),
+        "related_inflight": list(_related_inflight.keys()),
+        "search_inflight": len(_search_inflight),
     }
 
 
@@ -364,17 +690,18 @@ async def cache_stats(username: str = Depends(get_user)) -> dict[str, Any]:  # n
 
 @app.get("/api/playlists")
 async def list_playlists(username: str = Depends(get_user)) -> dict[str, Any]:
-    data = load_user(username)
+    data = await load_user(username)
     playlists: dict[str, Any] = data.get("playlists", {})
     # Return metadata only (id, name, count, thumbnail of first track)
     summary = []
     for pid, pl in playlists.items():
-        tracks: list[dict[str, Any]] = pl.get("tracks", [])
+        tracks: dict[str, dict[str, Any]] = pl.get("tracks", {})
+        first = next(iter(tracks.values()), None)
         summary.append({
             "id": pid,
             "name": pl.get("name", "Untitled"),
             "count": len(tracks),
-            "thumbnail": tracks[0].get("thumbnail") if tracks else None,
+            "thumbnail": first.get("thumbnail") if first else None,
             "created_at": pl.get("created_at", 0),
         })
     summary.sort(key=lambda x: x["created_at"], reverse=True)
@@ -386,26 +713,26 @@ async def create_playlist(
     name: str = Body(..., embed=True),
     username: str = Depends(get_user),
 ) -> dict[str, Any]:
-    data = load_user(username)
+    data = await load_user(username)
     playlists: dict[str, Any] = data.setdefault("playlists", {})
     pid = secrets.token_urlsafe(8)
-    playlists[pid] = {"name": name, "tracks": [], "created_at": time.time()}
+    playlists[pid] = {"name": name, "tracks": {}, "created_at": time.time()}
     save_user(username, data)
     return {"id": pid, "name": name}
 
 
 @app.get("/api/playlists/{playlist_id}")
 async def get_playlist(playlist_id: str, username: str = Depends(get_user)) -> dict[str, Any]:
-    data = load_user(username)
+    data = await load_user(username)
     pl = data.get("playlists", {}).get(playlist_id)
     if not pl:
         raise HTTPException(status_code=404, detail="Playlist not found")
-    return {"id": playlist_id, **pl}
+    return {"id": playlist_id, **pl, "tracks": list(pl.get("tracks", {}).values())}
 
 
 @app.delete("/api/playlists/{playlist_id}")
 async def delete_playlist(playlist_id: str, username: str = Depends(get_user)) -> dict[str, Any]:
-    data = load_user(username)
+    data = await load_user(username)
     playlists: dict[str, Any] = data.get("playlists", {})
     if playlist_id not in playlists:
         raise HTTPException(status_code=404, detail="Playlist not found")
@@ -420,7 +747,7 @@ async def rename_playlist(
     name: str = Body(..., embed=True),
     username: str = Depends(get_user),
 ) -> dict[str, Any]:
-    data = load_user(username)
+    data = await load_user(username)
     pl = data.get("playlists", {}).get(playlist_id)
     if not pl:
         raise HTTPException(status_code=404, detail="Playlist not found")
@@ -435,14 +762,21 @@ async def add_to_playlist(
     track: dict[str, Any] = Body(...),
     username: str = Depends(get_user),
 ) -> dict[str, Any]:
-    data = load_user(username)
+    data = await load_user(username)
     pl = data.get("playlists", {}).get(playlist_id)
     if not pl:
         raise HTTPException(status_code=404, detail="Playlist not found")
-    tracks: list[dict[str, Any]] = pl.setdefault("tracks", [])
-    # Avoid duplicates
-    if not any(t.get("id") == track.get("id") for t in tracks):
-        tracks.append(track)
+    track_id = track.get("id")
+    if not track_id or not isinstance(track_id, str):
+        raise HTTPException(status_code=422, detail="Track id must be a non-empty string")
+    try:
+        # The body is persisted as-is, so it must be something orjson can write back out
+        orjson.dumps(track)
+    except orjson.JSONEncodeError as exc:
+        raise HTTPException(status_code=422, detail=f"Track can't be stored: {exc}") from exc
+    tracks: dict[str, dict[str, Any]] = pl.setdefault("tracks", {})
+    # Avoid duplicates (keeps the original position)
+    tracks.setdefault(track_id, track)
     save_user(username, data)
     return {"count": len(tracks)}
 
@@ -453,11 +787,11 @@ async def remove_from_playlist(
     video_id: str,
     username: str = Depends(get_user),
 ) -> dict[str, Any]:
-    data = load_user(username)
+    data = await load_user(username)
     pl = data.get("playlists", {}).get(playlist_id)
     if not pl:
         raise HTTPException(status_code=404, detail="Playlist not found")
-    pl["tracks"] = [t for t in pl.get("tracks", []) if t.get("id") != video_id]
+    pl.setdefault("tracks", {}).pop(video_id, None)
     save_user(username, data)
     return {"count": len(pl["tracks"])}
 
@@ -469,13 +803,12 @@ async def reorder_playlist(
     username: str = Depends(get_user),
 ) -> dict[str, Any]:
     """Reorder tracks by providing an ordered list of video IDs."""
-    data = load_user(username)
+    data = await load_user(username)
     pl = data.get("playlists", {}).get(playlist_id)
     if not pl:
         raise HTTPException(status_code=404, detail="Playlist not found")
-    tracks: list[dict[str, Any]] = pl.get("tracks", [])
-    track_map = {t["id"]: t for t in tracks}
-    pl["tracks"] = [track_map[tid] for tid in track_ids if tid in track_map]
+    tracks: dict[str, dict[str, Any]] = pl.get("tracks", {})
+    pl["tracks"] = {tid: tracks[tid] for tid in track_ids if tid in tracks}
     save_user(username, data)
     return {"count": len(pl["tracks"])}
 
@@ -484,4 +817,5 @@ async def reorder_playlist(
 if __name__ == "__main__":
     import uvicorn
     print("🎵 Pi Music Server v2 starting on http://0.0.0.0:8080")
-    uvicorn.run("server:app", host="0.0.0.0", port=8080, reload=False)
+    # Single worker: user data and video caches live in this process's memory
+    uvicorn.run("server:app", host="0.0.0.0", port=8080, loop="uvloop", http="httptools", reload=False)